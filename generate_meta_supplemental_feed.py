@@ -1,7 +1,11 @@
 import os
 import csv
 import sys
+import time
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---- ENV (strip everything to avoid hidden whitespace/newlines) ----
 SHOP = os.environ["SHOP"].strip()  # e.g. misquoters.myshopify.com
@@ -17,8 +21,42 @@ AUTHOR_NAMESPACE = (os.environ.get("AUTHOR_NAMESPACE") or "custom").strip()
 AUTHOR_KEY = (os.environ.get("AUTHOR_KEY") or "author").strip()
 META_LABEL_COL = (os.environ.get("META_LABEL_COL") or "custom_label_0").strip()
 
+# Optional Shopify product search to skip products without an author
+# server-side, e.g. "metafields.custom.author:*". Off by default: it only works
+# if the metafield definition is filterable in the store.
+PRODUCT_SEARCH = (os.environ.get("PRODUCT_SEARCH") or "").strip()
+
 OUT_CSV = os.environ.get("OUT_CSV", "meta_supplemental_feed.csv").strip()
 
+BULK_POLL_SECONDS = 3
+BULK_MAX_WAIT_SECONDS = 30 * 60
+
+# One keep-alive session for every call, so repeated requests reuse the
+# same TCP/TLS connection instead of handshaking per call.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=None,  # GraphQL reads are POSTs; retry them too
+        ),
+    ),
+)
+# GraphQL/JSONL bodies are mostly repeated keys and compress very well;
+# urllib3 decodes brotli transparently when the `brotli` package is installed.
+SESSION.headers["Accept-Encoding"] = "br, gzip"
+
+# Mutations are not safe to retry: if Shopify accepted a bulkOperationRunQuery
+# whose response got lost, a retry would start a second bulk operation.
+# They go through their own session that never retries.
+MUTATION_SESSION = requests.Session()
+MUTATION_SESSION.mount("https://", HTTPAdapter(max_retries=0))
+
 
 def get_access_token():
     """
@@ -35,7 +73,7 @@ def get_access_token():
         "grant_type": "client_credentials",
         "scope": "read_products",
     }
-    r = requests.post(token_url, json=payload, timeout=60)
+    r = SESSION.post(token_url, json=payload, timeout=60)
     r.raise_for_status()
     data = r.json()
     if "access_token" not in data:
@@ -51,32 +89,79 @@ HEADERS = {
     "X-Shopify-Access-Token": TOKEN,
     "Content-Type": "application/json",
 }
-
-# We query both:
-# - metafield(namespace,key) for the exact lookup
-# - metafields(namespace:first...) for DEBUG visibility if rows end up 0
-QUERY = f"""
-query ProductsWithAuthor($cursor: String) {{
-  products(first: 100, after: $cursor) {{
-    pageInfo {{ hasNextPage endCursor }}
+SESSION.headers.update(HEADERS)
+MUTATION_SESSION.headers.update(SESSION.headers)
+
+# Production query, run as a bulk operation: Shopify walks every product
+# and variant server-side and hands back a single JSONL file, one object
+# per line, with variants pointing at their product via __parentId.
+# Bulk operations traverse every connection in full, so no `first:` or
+# variant pageInfo is needed: products with more than 100 (or 250)
+# variants get all of their rows.
+# Bulk queries can't take variables, so the search string is inlined
+# (JSON string escaping is valid GraphQL string escaping).
+PRODUCTS_ARGS = f"(query: {orjson.dumps(PRODUCT_SEARCH).decode()})" if PRODUCT_SEARCH else ""
+BULK_QUERY = f"""
+{{
+  products{PRODUCTS_ARGS} {{
     edges {{
       node {{
         id
-        title
         metafield(namespace: "{AUTHOR_NAMESPACE}", key: "{AUTHOR_KEY}") {{ value }}
-
-        # Debug: show what metafields exist in this namespace
-        metafields(first: 20, namespace: "{AUTHOR_NAMESPACE}") {{
+        variants {{
           edges {{
-            node {{ namespace key value }}
+            node {{
+              legacyResourceId
+            }}
           }}
         }}
+      }}
+    }}
+  }}
+}}
+"""
+
+BULK_RUN_MUTATION = """
+mutation RunBulkQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
 
-        variants(first: 100) {{
+BULK_CANCEL_MUTATION = """
+mutation CancelBulkOperation($id: ID!) {
+  bulkOperationCancel(id: $id) {
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_STATUS_QUERY = """
+query BulkOperationStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { status errorCode url }
+  }
+}
+"""
+
+# Debug query, only run once if we end up with 0 rows:
+# - metafield(namespace,key) for the exact lookup
+# - metafields(namespace:first...) to show what exists in the namespace
+# - productsCount in the same request, to compare against products scanned
+#   (limit: null, otherwise Shopify caps the count at 10000)
+QUERY_DEBUG = f"""
+query ProductsDebug {{
+  productsCount(limit: null) {{ count }}
+  products(first: 5) {{
+    edges {{
+      node {{
+        title
+        metafield(namespace: "{AUTHOR_NAMESPACE}", key: "{AUTHOR_KEY}") {{ value }}
+        metafields(first: 20, namespace: "{AUTHOR_NAMESPACE}") {{
           edges {{
-            node {{
-              legacyResourceId
-            }}
+            node {{ namespace key value }}
           }}
         }}
       }}
@@ -86,91 +171,204 @@ query ProductsWithAuthor($cursor: String) {{
 """
 
 
-def gql(variables):
-    r = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": QUERY, "variables": variables},
-        timeout=60,
-    )
+def gql(query, variables, session=SESSION):
+    return gql_body(orjson.dumps({"query": query, "variables": variables}), session)
+
+
+def gql_body(body, session=SESSION):
+    """
+    POST an already-encoded GraphQL request body and return its `data`.
+    """
+    r = session.post(GRAPHQL_URL, data=body, timeout=60)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     if "errors" in data:
         raise RuntimeError(data["errors"])
     return data["data"]
 
 
-def main():
-    rows = []
-    cursor = None
+def run_bulk_query():
+    """
+    Start a bulk operation for BULK_QUERY and wait for it to finish.
+    Returns the URL of the JSONL result, or None if there were no objects.
+    """
+    data = gql(BULK_RUN_MUTATION, {"query": BULK_QUERY}, MUTATION_SESSION)
+    result = data["bulkOperationRunQuery"]
+    if result["userErrors"]:
+        raise RuntimeError(result["userErrors"])
+    op_id = result["bulkOperation"]["id"]
+
+    # The poll request never changes, so encode it once
+    status_body = orjson.dumps({"query": BULK_STATUS_QUERY, "variables": {"id": op_id}})
+    deadline = time.monotonic() + BULK_MAX_WAIT_SECONDS
+
+    while True:
+        op = gql_body(status_body)["node"]
+        status = op["status"]
+        if status == "COMPLETED":
+            return op["url"]
+        if status not in ("CREATED", "RUNNING"):
+            raise RuntimeError(f"Bulk operation {op_id} ended as {status}: {op['errorCode']}")
+        if time.monotonic() > deadline:
+            cancel_bulk_operation(op_id)
+            raise RuntimeError(
+                f"Bulk operation {op_id} still {status} after {BULK_MAX_WAIT_SECONDS}s"
+            )
+        time.sleep(BULK_POLL_SECONDS)
+
+
+def cancel_bulk_operation(op_id):
+    """
+    Best-effort cancel of a bulk operation we gave up waiting for, so it
+    doesn't keep running (and holding a bulk slot) after we exit.
+    """
+    try:
+        data = gql(BULK_CANCEL_MUTATION, {"id": op_id}, MUTATION_SESSION)
+        errors = data["bulkOperationCancel"]["userErrors"]
+        if errors:
+            print(f"⚠️ Could not cancel bulk operation {op_id}: {errors}")
+    except Exception as e:
+        print(f"⚠️ Could not cancel bulk operation {op_id}: {e}")
+
+
+def iter_bulk_objects(url):
+    """
+    Stream the bulk operation's JSONL result, yielding one object per line.
+    """
+    # The result lives on a signed storage URL, so don't send it our token
+    with SESSION.get(
+        url,
+        headers={"X-Shopify-Access-Token": None, "Content-Type": None},
+        stream=True,
+        timeout=60,
+    ) as r:
+        r.raise_for_status()
+        # Read in 64 KB chunks; iter_lines() defaults to 512 bytes
+        for line in r.iter_lines(chunk_size=1 << 16):
+            if line:
+                yield orjson.loads(line)
+
+
+def write_feed(url, path):
+    """
+    Stream the bulk result at `url` into a CSV at `path`.
+    Returns (products scanned, rows written, variants with no product line).
+    """
     total_products = 0
     total_variants = 0
 
-    # Keep a small debug sample to print if we get 0 rows
-    debug_samples = []
+    # Stream rows straight to disk as the bulk result is read.
+    # Remember each product's author ("" if unset) and look it up from the
+    # variant's __parentId. The JSONL isn't guaranteed to list a product
+    # before its variants, so variants whose product hasn't been seen yet
+    # wait in `orphans` until it arrives.
+    authors = {}
+    orphans = {}
+    # Variant IDs already written, so each one appears in the feed only once
+    seen = set()
+    # 1 MB write buffer: the feed is many short rows, so flush rarely
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(["id", META_LABEL_COL])
+
+        # Bind the per-line method lookups once; this loop runs per variant
+        write_row = w.writerow
+        get_author = authors.get
+        mark_seen = seen.add
+
+        for obj in iter_bulk_objects(url) if url else ():
+            parent_id = obj.get("__parentId")
+
+            if parent_id is None:
+                total_products += 1
+                mf = obj["metafield"]
+                author = mf["value"].strip() if mf and mf["value"] else ""
+                authors[obj["id"]] = author
+                waiting = orphans.pop(obj["id"], ())
+                # PRODUCT_SEARCH, if set, should already exclude empty authors
+                if not author:
+                    continue
+                for variant_id in waiting:
+                    if variant_id not in seen:
+                        mark_seen(variant_id)
+                        write_row((variant_id, author))
+                        total_variants += 1
+                continue
 
-    while True:
-        data = gql({"cursor": cursor})
-        products = data["products"]
-        total_products += len(products["edges"])
-
-        for edge in products["edges"]:
-            p = edge["node"]
-
-            mf = p.get("metafield")
-            author = (mf.get("value") if mf else "") or ""
-            author = str(author).strip()
-
-            # capture a few debug samples
-            if len(debug_samples) < 5:
-                ns_mfs = p.get("metafields", {}).get("edges", [])
-                debug_samples.append({
-                    "title": p.get("title", ""),
-                    "exact_lookup_value": author,
-                    "namespace_metafields": [
-                        f'{e["node"]["namespace"]}.{e["node"]["key"]}={e["node"]["value"]}'
-                        for e in ns_mfs
-                    ],
-                })
-
-            if not author:
+            variant_id = obj["legacyResourceId"]
+            if not variant_id:
                 continue
 
-            for v_edge in p["variants"]["edges"]:
-                v = v_edge["node"]
-                variant_id = v.get("legacyResourceId")
-                if not variant_id:
-                    continue
+            author = get_author(parent_id)
+            if author is None:
+                orphans.setdefault(parent_id, []).append(variant_id)
+                continue
+            if not author or variant_id in seen:
+                continue
+            mark_seen(variant_id)
+
+            # legacyResourceId is already a String scalar; write it as-is
+            write_row((variant_id, author))
+            total_variants += 1
+
+    orphan_count = sum(map(len, orphans.values()))
+    return total_products, total_variants, orphan_count
 
-                rows.append({
-                    "id": str(variant_id),
-                    META_LABEL_COL: author
-                })
-                total_variants += 1
 
-        if not products["pageInfo"]["hasNextPage"]:
-            break
-        cursor = products["pageInfo"]["endCursor"]
+def main():
+    url = run_bulk_query()
+
+    # A search that matches nothing most likely means the store doesn't
+    # support it; fail rather than overwrite the feed with an empty CSV.
+    if url is None and PRODUCT_SEARCH:
+        raise RuntimeError(
+            f"PRODUCT_SEARCH {PRODUCT_SEARCH!r} matched no products; "
+            "check the filter or unset it to scan every product."
+        )
+
+    # Write to a temp file next to OUT_CSV and only swap it in once the whole
+    # result has been read, so a failed download never leaves a partial feed.
+    tmp_csv = OUT_CSV + ".tmp"
+    try:
+        total_products, total_variants, orphan_count = write_feed(url, tmp_csv)
+    except BaseException:
+        if os.path.exists(tmp_csv):
+            os.remove(tmp_csv)
+        raise
+    os.replace(tmp_csv, OUT_CSV)
 
-    fieldnames = ["id", META_LABEL_COL]
-    with open(OUT_CSV, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        w.writerows(rows)
+    if orphan_count:
+        print(f"⚠️ {orphan_count} variants had no product line in the bulk result")
 
     print(f"✅ Wrote {OUT_CSV}")
     print(f"Products scanned: {total_products}")
     print(f"Rows written (variants with author): {total_variants}")
 
     if total_variants == 0:
-        print("\n--- DEBUG (first 5 products) ---")
-        print(f"Looking for metafield: {AUTHOR_NAMESPACE}.{AUTHOR_KEY}")
-        for s in debug_samples:
-            print(f'\nProduct: {s["title"]}')
-            print(f'Exact lookup value: {s["exact_lookup_value"]!r}')
-            print("Metafields in namespace:")
-            for line in s["namespace_metafields"]:
-                print(f"  - {line}")
+        print_debug_samples()
+
+
+def print_debug_samples():
+    """
+    Fetch the first few products with their namespace metafields and print
+    them, to help work out why nothing matched the exact lookup.
+    """
+    data = gql(QUERY_DEBUG, {})
+
+    print("\n--- DEBUG (first 5 products) ---")
+    print(f'Products in store: {data["productsCount"]["count"]}')
+    print(f"Looking for metafield: {AUTHOR_NAMESPACE}.{AUTHOR_KEY}")
+    print(f"Product search filter: {PRODUCT_SEARCH!r}")
+    for edge in data["products"]["edges"]:
+        p = edge["node"]
+        mf = p["metafield"]
+        author = mf["value"].strip() if mf and mf["value"] else ""
+
+        print(f'\nProduct: {p["title"]}')
+        print(f"Exact lookup value: {author!r}")
+        print("Metafields in namespace:")
+        for e in p["metafields"]["edges"]:
+            print(f'  - {e["node"]["namespace"]}.{e["node"]["key"]}={e["node"]["value"]}')
 
 
 if __name__ == "__main__":